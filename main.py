@@ -1,28 +1,86 @@
 # main.py
 import streamlit as st
 import pandas as pd
-import smtplib
+import numpy as np
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+import aiosmtplib
+import asyncio
 import re
-import email.mime.text
-import email.mime.multipart
+import email.policy
+from email.message import EmailMessage
 import io
 import time
-from typing import Dict, List, Tuple, Optional
+import functools
+import threading
+from typing import Callable, Dict, List, NamedTuple, Tuple, Optional
+
+SMTP_HOST = 'smtp.gmail.com'
+SMTP_PORT = 587
+TRANSIENT_SMTP_CODES = {421, 450, 454}
+MAX_SEND_RETRIES = 3
+RETRY_BASE_DELAY = 1.0
+MAX_LINE_LENGTH = 998
+KEEPALIVE_INTERVAL = 20.0
+UI_UPDATE_INTERVAL = 0.1
+
+TEXT_DTYPE = pd.ArrowDtype(pa.string()) if pa is not None else 'string'
+CSV_DTYPES = {'name': TEXT_DTYPE, 'email': TEXT_DTYPE}
+
+_EMAIL_RE = re.compile(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$')
+_PLACEHOLDER_RE = re.compile(r'\{\{(\w+)\}\}')
+
+_thread_state = threading.local()
 
 def validate_email(email: str) -> bool:
-    pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
-    return re.match(pattern, email) is not None
+    return _EMAIL_RE.match(email) is not None
 
 def extract_placeholders(template: str) -> List[str]:
-    placeholders = re.findall(r'\{\{(\w+)\}\}', template)
-    return list(set(placeholders))
+    return list({*_PLACEHOLDER_RE.findall(template)})
+
+def split_template(template: str) -> List[str]:
+    # [text, name, text, name, ..., text]
+    return _PLACEHOLDER_RE.split(template)
 
-def replace_placeholders(template: str, data: Dict[str, str]) -> str:
-    result = template
-    for key, value in data.items():
-        placeholder = f"{{{{{key}}}}}"
-        result = result.replace(placeholder, str(value))
-    return result
+def make_renderer(template: str, columns: List[str]):
+    name_to_col = {name: j for j, name in enumerate(columns)}
+    parts, slots = [], []
+    for i, part in enumerate(split_template(template)):
+        if i % 2 == 1 and part in name_to_col:
+            parts.append(part)
+            slots.append(name_to_col[part])
+        else:
+            parts.append(part if i % 2 == 0 else f"{{{{{part}}}}}")
+            slots.append(None)
+
+    @functools.lru_cache(maxsize=4096)
+    def render(key: Tuple) -> str:
+        return ''.join(part if slot is None else str(key[slot]) for part, slot in zip(parts, slots))
+
+    return render
+
+class Job(NamedTuple):
+    email: str
+    name: str
+    body: str
+
+def prepare_jobs(template: str, df: pd.DataFrame, placeholders: List[str]) -> List[Job]:
+    placeholder_cols = [c for c in placeholders if c in df.columns]
+    render = make_renderer(template, placeholder_cols)
+    columns = [df['email'], df['name']] + [df[c].astype(TEXT_DTYPE).fillna('') for c in placeholder_cols]
+    jobs = []
+    for row in zip(*columns):
+        jobs.append(Job(row[0], row[1], render(row[2:])))
+    return jobs
+
+def read_csv(csv_file) -> pd.DataFrame:
+    try:
+        return pd.read_csv(csv_file, engine='pyarrow', dtype_backend='pyarrow', dtype=CSV_DTYPES)
+    except ImportError:
+        csv_file.seek(0)
+        return pd.read_csv(csv_file, dtype=CSV_DTYPES)
 
 def validate_csv_columns(df: pd.DataFrame) -> Tuple[bool, str]:
     required_columns = ['name', 'email']
@@ -32,35 +90,201 @@ def validate_csv_columns(df: pd.DataFrame) -> Tuple[bool, str]:
         return False, f"Missing required columns: {', '.join(missing_columns)}"
 
     for col in required_columns:
-        if df[col].isnull().any() or (df[col] == '').any():
+        if df[col].replace('', pd.NA).isna().any():
             return False, f"Column '{col}' contains empty values"
 
-    invalid_emails = []
-    for idx, email in enumerate(df['email']):
-        if not validate_email(email):
-            invalid_emails.append(f"Row {idx + 1}: {email}")
+    emails = df['email']
+    mask = emails.str.match(_EMAIL_RE.pattern)
+    bad_idx = np.flatnonzero(~mask.to_numpy(dtype=bool))[:5]
+    invalid_emails = [f"Row {idx + 1}: {email}" for idx, email in zip(bad_idx, emails.to_numpy()[bad_idx])]
 
     if invalid_emails:
-        return False, f"Invalid email addresses found:\n" + "\n".join(invalid_emails[:5])
+        return False, f"Invalid email addresses found:\n" + "\n".join(invalid_emails)
 
     return True, "CSV validation successful"
 
-def send_email(smtp_server, sender_email: str, recipient_email: str, subject: str, body: str, is_html: bool = False) -> Tuple[bool, str]:
+@st.cache_data
+def load_template(raw_bytes: bytes) -> Tuple[str, List[str]]:
+    template = raw_bytes.decode('utf-8')
+    return template, extract_placeholders(template)
+
+@st.cache_data
+def load_csv(raw_bytes: bytes) -> Tuple[pd.DataFrame, bool, str]:
+    df = read_csv(io.BytesIO(raw_bytes))
+    is_valid, message = validate_csv_columns(df)
+    return df, is_valid, message
+
+async def connect_smtp(sender_email: str, sender_password: str) -> aiosmtplib.SMTP:
+    client = aiosmtplib.SMTP(hostname=SMTP_HOST, port=SMTP_PORT, start_tls=True)
+    await client.connect()
     try:
-        msg = email.mime.multipart.MIMEMultipart()
+        await client.login(sender_email, sender_password)
+    except Exception:
+        client.close()
+        raise
+    return client
+
+async def check_connection(sender_email: str, sender_password: str) -> None:
+    client = await connect_smtp(sender_email, sender_password)
+    await client.quit()
+
+class SMTPPool:
+    def __init__(self, sender_email: str, sender_password: str):
+        self._sender_email = sender_email
+        self._sender_password = sender_password
+        self._connections = asyncio.Queue()
+
+    async def open(self, size: int) -> None:
+        results = await asyncio.gather(
+            *(connect_smtp(self._sender_email, self._sender_password) for _ in range(size)),
+            return_exceptions=True,
+        )
+        for result in results:
+            if not isinstance(result, BaseException):
+                self.put(result)
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors:
+            await self.close()
+            raise errors[0]
+
+    async def get(self) -> aiosmtplib.SMTP:
+        client, last_activity = await self._connections.get()
+        if time.monotonic() - last_activity > KEEPALIVE_INTERVAL:
+            try:
+                await client.noop()
+            except aiosmtplib.SMTPException:
+                try:
+                    client = await self.reconnect(client)
+                except Exception:
+                    # Put it back anyway so waiting sends are not starved
+                    self.put(client)
+                    raise
+        return client
+
+    def put(self, client: aiosmtplib.SMTP) -> None:
+        self._connections.put_nowait((client, time.monotonic()))
+
+    async def reconnect(self, client: aiosmtplib.SMTP) -> aiosmtplib.SMTP:
+        client.close()
+        return await connect_smtp(self._sender_email, self._sender_password)
+
+    async def close(self) -> None:
+        while not self._connections.empty():
+            client, _ = self._connections.get_nowait()
+            try:
+                await client.quit()
+            except Exception:
+                client.close()
+
+def get_message_skeleton(sender_email: str, subject: str) -> EmailMessage:
+    key = (sender_email, subject)
+    if getattr(_thread_state, 'message_key', None) != key:
+        msg = EmailMessage()
         msg['From'] = sender_email
-        msg['To'] = recipient_email
+        msg['To'] = ''
         msg['Subject'] = subject
+        _thread_state.message = msg
+        _thread_state.message_key = key
+    return _thread_state.message
 
-        if is_html:
-            msg.attach(email.mime.text.MIMEText(body, 'html'))
-        else:
-            msg.attach(email.mime.text.MIMEText(body, 'plain'))
+def build_raw_message(sender_email: str, recipient_email: str, subject: str, body: str) -> Optional[bytes]:
+    headers = f"{sender_email}{recipient_email}{subject}"
+    if not headers.isascii() or '\r' in headers or '\n' in headers:
+        return None
+    if len(f"Subject: {subject}") > MAX_LINE_LENGTH:
+        return None
+    lines = body.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+    if any(len(line.encode('utf-8')) > MAX_LINE_LENGTH for line in lines):
+        return None
+    raw = (
+        f"From: {sender_email}\r\n"
+        f"To: {recipient_email}\r\n"
+        f"Subject: {subject}\r\n"
+        "MIME-Version: 1.0\r\n"
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Content-Transfer-Encoding: {'7bit' if body.isascii() else '8bit'}\r\n"
+        "\r\n"
+    )
+    return (raw + '\r\n'.join(lines)).encode('utf-8')
+
+async def send_email(client: aiosmtplib.SMTP, sender_email: str, recipient_email: str, subject: str, body: str, is_html: bool = False) -> Tuple[bool, str]:
+    raw = None if is_html else build_raw_message(sender_email, recipient_email, subject, body)
+    if raw is None:
+        # Shared by this thread's tasks: serialize before the next await
+        msg = get_message_skeleton(sender_email, subject)
+        msg.replace_header('To', recipient_email)
+        msg.set_content(body, subtype='html' if is_html else 'plain')
+        raw = msg.as_bytes(policy=email.policy.SMTP)
+    mail_options = [] if raw.isascii() else ['BODY=8BITMIME']
+
+    for attempt in range(MAX_SEND_RETRIES + 1):
+        try:
+            errors, _ = await client.sendmail(sender_email, [recipient_email], raw, mail_options=mail_options)
+            refused = {recipient: (response.code, response.message) for recipient, response in errors.items()}
+        except aiosmtplib.SMTPRecipientsRefused as e:
+            refused = {error.recipient: (error.code, error.message) for error in e.recipients}
+        except aiosmtplib.SMTPResponseException as e:
+            if e.code in TRANSIENT_SMTP_CODES and attempt < MAX_SEND_RETRIES:
+                await _reset_before_retry(client, attempt)
+                continue
+            return False, f"Failed to send email: {str(e)}"
+
+        if not refused:
+            return True, "Email sent successfully"
+        codes = [code for code, _ in refused.values()]
+        if all(code in TRANSIENT_SMTP_CODES for code in codes) and attempt < MAX_SEND_RETRIES:
+            await _reset_before_retry(client, attempt)
+            continue
+        return False, f"Recipient refused: {refused}"
+
+async def _reset_before_retry(client: aiosmtplib.SMTP, attempt: int) -> None:
+    try:
+        await client.rset()
+    except aiosmtplib.SMTPServerDisconnected:
+        raise
+    except aiosmtplib.SMTPException:
+        pass
+    await asyncio.sleep(RETRY_BASE_DELAY * 2 ** attempt)
+
+async def send_with_pool(pool: SMTPPool, sender_email: str, recipient_email: str, subject: str, body: str, is_html: bool = False) -> Tuple[bool, str]:
+    client = await pool.get()
+    try:
+        try:
+            return await send_email(client, sender_email, recipient_email, subject, body, is_html)
+        except aiosmtplib.SMTPServerDisconnected:
+            client = await pool.reconnect(client)
+            return await send_email(client, sender_email, recipient_email, subject, body, is_html)
+    finally:
+        pool.put(client)
 
-        smtp_server.send_message(msg)
-        return True, "Email sent successfully"
-    except Exception as e:
-        return False, f"Failed to send email: {str(e)}"
+async def send_all(jobs: List[Job], sender_email: str, sender_password: str, subject: str, is_html: bool,
+                   connection_count: int, on_result: Callable[[Job, bool, str], None]) -> None:
+    if not jobs:
+        return
+    pool = SMTPPool(sender_email, sender_password)
+    await pool.open(min(connection_count, len(jobs)))
+
+    async def send_job(job: Job) -> Tuple[Job, Tuple[bool, str]]:
+        try:
+            return job, await send_with_pool(pool, sender_email, job.email, subject, job.body, is_html)
+        except Exception as e:
+            return job, (False, f"Error: {str(e)}")
+
+    try:
+        for next_result in asyncio.as_completed([send_job(job) for job in jobs]):
+            job, (success, message) = await next_result
+            on_result(job, success, message)
+    finally:
+        await pool.close()
+
+def empty_results() -> Dict[str, list]:
+    return {'recipient': [], 'name': [], 'success': [], 'message': []}
+
+def record_result(results: Dict[str, list], recipient: str, name: str, success: bool, message: str) -> None:
+    results['recipient'].append(recipient)
+    results['name'].append(name)
+    results['success'].append(success)
+    results['message'].append(message)
 
 def main():
     st.set_page_config(page_title="Email Automation Tool", page_icon="📧", layout="wide")
@@ -68,7 +292,7 @@ def main():
     st.markdown("Upload your template and CSV file to send personalized emails via Gmail SMTP")
 
     if 'email_results' not in st.session_state:
-        st.session_state.email_results = []
+        st.session_state.email_results = empty_results()
     if 'preview_data' not in st.session_state:
         st.session_state.preview_data = None
 
@@ -76,6 +300,7 @@ def main():
         st.header("Gmail Configuration")
         sender_email = st.text_input("Gmail Address", placeholder="your.email@gmail.com")
         sender_password = st.text_input("App Password", type="password", help="Use Gmail App Password")
+        connection_count = st.slider("Concurrent Connections", min_value=1, max_value=15, value=5, help="Number of parallel SMTP connections used when sending")
 
         if st.button("Test Connection"):
             if sender_email and sender_password:
@@ -84,10 +309,7 @@ def main():
                 else:
                     try:
                         with st.spinner("Testing connection..."):
-                            server = smtplib.SMTP('smtp.gmail.com', 587)
-                            server.starttls()
-                            server.login(sender_email, sender_password)
-                            server.quit()
+                            asyncio.run(check_connection(sender_email, sender_password))
                         st.success("✅ Connection successful!")
                     except Exception as e:
                         st.error(f"❌ Connection failed: {str(e)}")
@@ -101,11 +323,11 @@ def main():
         template_file = st.file_uploader("Choose template file", type=['txt', 'html'])
         if template_file:
             try:
-                template_content = template_file.read().decode('utf-8')
+                template_content, placeholders = load_template(template_file.getvalue())
+                is_html = template_file.name.endswith('.html')
                 st.success(f"✅ Template loaded: {template_file.name}")
                 with st.expander("Preview Template"):
-                    st.code(template_content, language='html' if template_file.name.endswith('.html') else 'text')
-                placeholders = extract_placeholders(template_content)
+                    st.code(template_content, language='html' if is_html else 'text')
                 if placeholders:
                     st.info(f"Placeholders found: {', '.join(placeholders)}")
                 else:
@@ -114,18 +336,19 @@ def main():
                 st.error(f"Error reading template file: {str(e)}")
                 template_content = None
                 placeholders = []
+                is_html = False
         else:
             template_content = None
             placeholders = []
+            is_html = False
 
     with col2:
         st.header("📊 Upload CSV Data")
         csv_file = st.file_uploader("Choose CSV file", type=['csv'])
         if csv_file:
             try:
-                df = pd.read_csv(csv_file)
+                df, is_valid, validation_message = load_csv(csv_file.getvalue())
                 st.success(f"✅ CSV loaded: {csv_file.name} ({len(df)} rows)")
-                is_valid, validation_message = validate_csv_columns(df)
                 if is_valid:
                     st.success(validation_message)
                     with st.expander("Preview Data"):
@@ -148,11 +371,11 @@ def main():
         if st.button("Generate Preview (First Row)"):
             try:
                 first_row = df.iloc[0].to_dict()
-                preview_content = replace_placeholders(template_content, first_row)
+                preview_content = prepare_jobs(template_content, df.head(1), placeholders)[0].body
                 st.session_state.preview_data = {
                     'recipient': first_row,
                     'content': preview_content,
-                    'is_html': template_file.name.endswith('.html') if template_file else False
+                    'is_html': is_html
                 }
             except Exception as e:
                 st.error(f"Error generating preview: {str(e)}")
@@ -167,71 +390,58 @@ def main():
     if template_content and df is not None and sender_email and sender_password and email_subject:
         st.header("🚀 Send Emails")
         if st.button("Send All Emails", type="primary"):
-            st.session_state.email_results = []
+            st.session_state.email_results = empty_results()
             if not validate_email(sender_email):
                 st.error("Invalid sender email address")
                 return
             try:
-                with st.spinner("Connecting to Gmail SMTP..."):
-                    server = smtplib.SMTP('smtp.gmail.com', 587)
-                    server.starttls()
-                    server.login(sender_email, sender_password)
-
                 progress_bar = st.progress(0)
                 status_text = st.empty()
-                is_html = template_file.name.endswith('.html') if template_file else False
+                jobs = prepare_jobs(template_content, df, placeholders)
+                total = len(jobs)
+                completed = 0
+                last_ui_update = 0.0
+
+                def on_result(job: Job, success: bool, message: str) -> None:
+                    nonlocal completed, last_ui_update
+                    record_result(st.session_state.email_results, job.email, job.name, success, message)
+                    completed += 1
+                    now = time.monotonic()
+                    if now - last_ui_update > UI_UPDATE_INTERVAL or completed == total:
+                        progress_bar.progress(completed / total)
+                        status_text.text(f"Sent {completed} of {total} (last: {job.email})")
+                        last_ui_update = now
+
+                with st.spinner("Sending emails via Gmail SMTP..."):
+                    asyncio.run(send_all(jobs, sender_email, sender_password, email_subject, is_html, connection_count, on_result))
 
-                for idx, row in df.iterrows():
-                    try:
-                        progress = (idx + 1) / len(df)
-                        progress_bar.progress(progress)
-                        status_text.text(f"Sending email {idx + 1} of {len(df)} to {row['email']}")
-                        personalized_content = replace_placeholders(template_content, row.to_dict())
-                        success, message = send_email(server, sender_email, row['email'], email_subject, personalized_content, is_html)
-                        st.session_state.email_results.append({
-                            'recipient': row['email'],
-                            'name': row['name'],
-                            'success': success,
-                            'message': message
-                        })
-                        time.sleep(0.5)
-                    except Exception as e:
-                        st.session_state.email_results.append({
-                            'recipient': row['email'],
-                            'name': row['name'],
-                            'success': False,
-                            'message': f"Error: {str(e)}"
-                        })
-
-                server.quit()
                 status_text.text("✅ Email sending completed!")
                 progress_bar.progress(1.0)
             except Exception as e:
                 st.error(f"SMTP connection error: {str(e)}")
 
-    if st.session_state.email_results:
+    if st.session_state.email_results['recipient']:
         st.header("📊 Sending Results")
-        successful = [r for r in st.session_state.email_results if r['success']]
-        failed = [r for r in st.session_state.email_results if not r['success']]
+        results_df = pd.DataFrame(st.session_state.email_results)
+        success_df = results_df[results_df['success']]
+        failed_df = results_df[~results_df['success']]
 
         col1, col2, col3 = st.columns(3)
         with col1:
-            st.metric("Total Sent", len(st.session_state.email_results))
+            st.metric("Total Sent", len(results_df))
         with col2:
-            st.metric("Successful", len(successful))
+            st.metric("Successful", len(success_df))
         with col3:
-            st.metric("Failed", len(failed))
+            st.metric("Failed", len(failed_df))
 
         tab1, tab2 = st.tabs(["✅ Successful", "❌ Failed"])
         with tab1:
-            if successful:
-                success_df = pd.DataFrame(successful)
+            if not success_df.empty:
                 st.dataframe(success_df[['name', 'recipient', 'message']])
             else:
                 st.info("No successful emails yet")
         with tab2:
-            if failed:
-                failed_df = pd.DataFrame(failed)
+            if not failed_df.empty:
                 st.dataframe(failed_df[['name', 'recipient', 'message']])
                 if st.button("Retry Failed Emails"):
                     st.info("Retry functionality would be implemented here")
@@ -239,7 +449,7 @@ def main():
                 st.success("No failed emails!")
 
         if st.button("Clear Results"):
-            st.session_state.email_results = []
+            st.session_state.email_results = empty_results()
             st.session_state.preview_data = None
             st.rerun()
 